@@ -58,6 +58,9 @@ Example::
 
    python mm12_gene_abundance.py --relab=rel_abundance.tsv --annotations-dir=anotations --annotation-type=gene --log=gene_abundance.tsv
 
+Tables are parsed and aggregated with pandas by default. If polars is installed, --engine=polars uses it
+instead, which is faster for large annotation sets.
+
 Type::
 
    python mm12_gene_abundance.py --help
@@ -68,7 +71,8 @@ Outputs
 --------
 
 The output of the script is a table that has each gene as a row and each sample as a column. The relationship between the strain that
-each gene has come from is not retained in the output file.
+each gene has come from is not retained in the output file. The table is tab separated by default; --output-format=parquet
+writes a parquet file instead (requires pyarrow or fastparquet).
 
 
 Command line options
@@ -79,119 +83,174 @@ Command line options
 import sys
 import cgatcore.experiment as E
 import os
-import collections
 import glob
+import concurrent.futures
+import numpy as np
 import pandas as pd
 
 ###########################################################
 # Classes and functions for use in the script
 ###########################################################
 
+# annotation file column and label for unannotated
+# entries for each annotation type
+ANNOTATION_COLUMNS = {"gene": ("gene", "unannotated_gene"),
+                      "ko": ("EC_number", "unannotated_ec"),
+                      "cog": ("COG", "unannotated_cog")}
+
 def read_relab(relab_file):
     '''
     read in data on relative abundance
-    of mm12 members
+    of mm12 members. Returns a dataframe of floats
+    with strains as rows and samples as columns
     '''
-    sample_dict = collections.defaultdict(dict)
-    relab = open(relab_file)
-    samples = relab.readline().strip("\n").split("\t")    
-    print(samples)    
-
-    sample_dict = collections.defaultdict(dict)
-    for line in relab.readlines():
-        data = line.strip("\n").split("\t")
-        strain = data[0]
-        for i in range(1, len(samples)):
-            sample_dict[samples[i]][strain] = data[i]
-    return(sample_dict)        
+    relab = pd.read_csv(relab_file, sep="\t", index_col=0).astype(float)
+    return(relab)
 
 ###########################################################
 ###########################################################
 ###########################################################
 
-class Annotation(object):
-
-    def __init__(self, locus_tag, ftype, length, gene, ec, cog, product):
+def build_annotation(infile, annotation_type="gene"):
+    '''
+    return the list of genes in an annotation
+    file. type has to be one of gene, ko or cog
+    '''
+    assert annotation_type in ["gene", "ko", "cog"], "annotation_type must be one of gene, ko or cog" 
 
-        self.locus_tag = locus_tag
-        self.ftype = ftype
-        self.length = length
-        self.gene = gene
-        self.ec = ec
-        self.cog = cog
-        self.product = product
+    column, unannotated = ANNOTATION_COLUMNS[annotation_type]
 
-        # set unnannotated genes to "unannotated_gene" etc
-        if self.gene == "":
-            self.gene = "unannotated_gene"
+    annotation = pd.read_csv(infile, sep="\t", header=0, usecols=[column], dtype=str, na_filter=False)[column]
 
-        # some of the genes are multiple
-        # for each strain and are denoted by _number
-        # get rid of the number associated
-        if len(self.gene.split("_")) == 2:
-            self.gene = self.gene.split("_")[0]
+    # some of the genes are multiple
+    # for each strain and are denoted by _number
+    # get rid of the number associated
+    if annotation_type == "gene":
+        multiple = annotation.str.count("_") == 1
+        annotation = annotation.where(~multiple, annotation.str.split("_").str[0])
 
-        if self.ec == "":
-            self.ec = "unannotated_ec"
-        if self.cog == "":
-            self.cog = "unannotated_cog"
-        if self.product == "":
-            self.product = "unannotated_gene_product"
+    # set unannotated genes to "unannotated_gene" etc
+    annotation = annotation.mask(annotation == "", unannotated)
+    return (annotation.tolist())
 
 ###########################################################
 ###########################################################
 ###########################################################
 
-def build_annotation(infile, annotation_type="gene"):
+def check_files(relab_file, annotations_dir):
     '''
-    return a dictionary with strain as key and list
-    of genes as values. type has to be one of 
-    gene, ko or cog
+    check that all of the strains are present
     '''
-    assert annotation_type in ["gene", "ko", "cog"], "annotation_type must be one of gene, ko or cog" 
-
-    strain = os.path.basename(infile).replace(".tsv", "")
-    annotations = collections.defaultdict(list)
-    with open(infile) as inf:
-        for line in inf.readlines():
-            data = line.strip("\n").split("\t")
-            annotation = Annotation(data[0], data[1], data[2], data[3], data[4], data[5], data[6])
-            if annotation_type == "gene":
-                annotations[strain].append(annotation.gene)
-            elif annotation_type == "ko":
-                annotations[strain].append(annotation.ec)
-            elif annotation_type == "cog":
-                annotations[strain].append(annotation.cog)
-    return (annotations)
+    have = {os.path.basename(x)[:-len(".tsv")] for x in glob.glob(annotations_dir + "/*.tsv")}
+    want = set(pd.read_csv(relab_file, sep="\t", usecols=[0], dtype=str).iloc[:, 0])
+    for strain in sorted(want - have):
+        E.warn("strain " + strain + " annotation file not found")
 
 ###########################################################
 ###########################################################
 ###########################################################
 
-def get_number_of_genes(annotations):
+def gene_abundance(relab_file, strain_to_path, annotation_type="gene", num_workers=None):
     '''
-    get the number of genes from an annotations
-    dictionary
+    calculate the relative abundance of each gene in each
+    sample. Returns a dataframe with genes as rows and
+    samples as columns
     '''
-    return (len(list(annotations.values())[0]))
+    # read relative abundance file
+    E.info("Reading relative abundance file...")
+    relab = read_relab(relab_file)
+
+    # read the annotations for each strain once. The files
+    # are independent so they are parsed in parallel
+    E.info("Reading annotations for " + ",".join(relab.index))
+    strains = list(relab.index)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        annotations_by_strain = dict(zip(strains, executor.map(build_annotation,
+                                                               [strain_to_path[strain] for strain in strains],
+                                                               [annotation_type] * len(strains))))
+    ngenes = np.array([len(annotations_by_strain[strain]) for strain in strains])
+
+    # the relative abundance of each gene is calculated
+    # as the relative abundance of the organism/number of genes.
+    # Genes and strains are converted to integer codes and the
+    # (gene, strain) counts accumulated in a single gene x strain
+    # array that is then multiplied by the strain x sample array
+    E.info("Calculating gene relative abundances")
+    samples = relab.columns
+    gene_codes, all_genes = pd.factorize(pd.Series([g for strain in strains for g in annotations_by_strain[strain]],
+                                                   dtype=object), sort=True)
+    all_genes = pd.Index(all_genes, name="gene")
+    strain_codes = np.repeat(np.arange(len(strains)), ngenes)
+    counts = np.bincount(gene_codes * len(strains) + strain_codes,
+                         minlength=len(all_genes) * len(strains)).reshape(len(all_genes), len(strains))
+    M = (counts / np.maximum(ngenes, 1)) @ relab.to_numpy()
+
+    return (pd.DataFrame(M, index=all_genes, columns=samples))
 
 ###########################################################
 ###########################################################
 ###########################################################
 
-def check_files(relab_file, annotations_dir):
+def gene_abundance_polars(relab_file, strain_to_path, annotation_type="gene"):
     '''
-    check that all of the strains are present
+    calculate the relative abundance of each gene in each
+    sample using polars for parsing and aggregation. Returns
+    the same dataframe as gene_abundance
     '''
-    relab = open(relab_file)
-    annotation_files = [x.replace(".tsv", "") for x in glob.glob(annotations_dir + "/*.tsv")]
-    relab.readline()
-    for line in relab.readlines():
-        data = line.strip("\n").split("\t")
-        strain = data[0]
-        if strain not in annotation_files:
-            E.warn("strain " + strain + " annotation file not found")
-            break
+    import polars as pl
+
+    column, unannotated = ANNOTATION_COLUMNS[annotation_type]
+
+    # read relative abundance file and make it long
+    # with one row per (strain, sample)
+    E.info("Reading relative abundance file...")
+    relab = pl.read_csv(relab_file, separator="\t")
+    relab = relab.rename({relab.columns[0]: "strain"})
+    samples = relab.columns[1:]
+    relab_long = relab.unpivot(index="strain", variable_name="sample", value_name="relab")
+
+    # read the annotations for each strain into a single
+    # table with one row per (strain, gene)
+    E.info("Reading annotations for " + ",".join(relab["strain"]))
+    frames = [pl.read_csv(strain_to_path[strain], separator="\t", columns=[column], infer_schema_length=0)
+              .rename({column: "gene"})
+              .with_columns(pl.lit(strain).alias("strain"))
+              for strain in relab["strain"]]
+    gene = pl.col("gene")
+    ann = pl.concat(frames)
+
+    # some of the genes are multiple
+    # for each strain and are denoted by _number
+    # get rid of the number associated
+    if annotation_type == "gene":
+        ann = ann.with_columns(pl.when(gene.str.count_matches("_") == 1)
+                               .then(gene.str.split("_").list.first())
+                               .otherwise(gene)
+                               .alias("gene"))
+
+    # set unannotated genes to "unannotated_gene" etc
+    # and record the number of genes in each strain
+    ann = ann.with_columns(pl.when(gene.is_null() | (gene == ""))
+                           .then(pl.lit(unannotated))
+                           .otherwise(gene)
+                           .alias("gene"),
+                           pl.len().over("strain").alias("ngenes"))
+
+    # the relative abundance of each gene is calculated
+    # as the relative abundance of the organism/number of genes
+    E.info("Calculating gene relative abundances")
+    out = (ann.lazy()
+           .join(relab_long.lazy(), on="strain")
+           .group_by(["gene", "sample"])
+           .agg((pl.col("relab") / pl.col("ngenes")).sum())
+           .collect()
+           .pivot(on="sample", index="gene", values="relab")
+           .fill_null(0)
+           .sort("gene"))
+
+    return (pd.DataFrame(out.select(samples).to_numpy(),
+                         index=pd.Index(out["gene"].to_list(), name="gene"),
+                         columns=samples))
 
 ###########################################################
 # End of classes and functions. Start of main script
@@ -216,6 +275,12 @@ def main(argv=None):
                         help="which type of annotation to use: gene, ko or cog")
     parser.add_argument("-o", "--outfile", dest="outfile", type=str,
                         help="where to output the resulting data")
+    parser.add_argument("-f", "--output-format", dest="output_format", type=str, choices=["tsv", "parquet"],
+                        default="tsv", help="format of the output table: tsv or parquet")
+    parser.add_argument("-e", "--engine", dest="engine", type=str, choices=["pandas", "polars"],
+                        default="pandas", help="library used to parse and aggregate the tables: pandas or polars")
+    parser.add_argument("-w", "--num-workers", dest="num_workers", type=int, default=None,
+                        help="number of processes used to read annotation files with the pandas engine (default: number of CPUs)")
 
 
     # add common options (-h/--help, ...) and parse command line
@@ -226,42 +291,22 @@ def main(argv=None):
     check_files(args.relab, args.annotations_dir)
     E.info("Inputs checked...OK")
 
-    # read relative abundance file
-    E.info("Reading relative abundance file...")
-    relab = read_relab(args.relab)
-
-    # iterate over the samples in relab
-    # and then the strains and calculate
-    # gene relative abundance from the
-    # annotation file
-    
+    # map each strain to its annotation file once so that
+    # lookups are constant time rather than a scan of the file list
     annotation_files = glob.glob(args.annotations_dir + "/*.tsv")
-    
-    # final dictionary of relative abundances for each gene
-    gene_relabs = collections.defaultdict(dict)
-
-    for sample, strain_relab in relab.items():
-        for strain, relab in strain_relab.items():
-            E.info("Calculating gene relative abundance for " + sample + " and annotations for " + strain)
-            annotation = [x for x in annotation_files if os.path.basename(x).replace(".tsv", "") == strain][0]
-            annotation = build_annotation(annotation, annotation_type=args.annotation_type)
-            ngenes = get_number_of_genes(annotation)
-            
-            # the relative abundance of each gene is calculated 
-            # as the relative abundance of the organism/mnumber of genes
-            for g in list(annotation.values())[0]:
-                if g == "gene":
-                    continue
-                try: 
-                  gene_relabs[sample][g] = gene_relabs[sample][g] + float(relab)/float(ngenes)
-                except KeyError:
-                  gene_relabs[sample][g] = float(relab)/float(ngenes)
-    
-    # get pandas dataframe for putput
-    df = pd.DataFrame(gene_relabs)
+    strain_to_path = {os.path.basename(x)[:-len(".tsv")]: x for x in annotation_files}
+
+    if args.engine == "polars":
+        df = gene_abundance_polars(args.relab, strain_to_path, annotation_type=args.annotation_type)
+    else:
+        df = gene_abundance(args.relab, strain_to_path, annotation_type=args.annotation_type,
+                            num_workers=args.num_workers)
 
     # write table
-    df.to_csv(args.outfile, sep="\t", index_label="gene") 
+    if args.output_format == "parquet":
+        df.to_parquet(args.outfile, compression="zstd")
+    else:
+        df.to_csv(args.outfile, sep="\t", index_label="gene", float_format="%.6g", chunksize=200000)
 
     # write footer and output benchmark information.
     E.stop()